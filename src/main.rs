@@ -1,175 +1,539 @@
 use serde::Deserialize;
-use std::io::{self, Result, Write};
-use std::process::{Command, Output};
-use std::{cmp, fs, path};
-use song_info::AudioFormatType;
+use std::io;
+use std::process::{self, Command, Output};
+use std::sync::{mpsc, Mutex};
+use std::{cmp, env, fs, path, thread};
+use remote::RemoteHost;
+use song_info::{AudioFormatType, SongInfo};
+mod probe_cache;
+mod remote;
 mod song_info;
 
-/// Function iterates through the directory and grabs file paths
-pub fn build_list_of_files(dir: &path::Path, files: &mut Vec<String>) {
+/// File extensions of formats that ffmpeg can convert for Rekordbox
+const SUPPORTED_EXTENSIONS: [&str; 7] = ["aiff", "aif", "flac", "wav", "mp3", "ogg", "aac"];
+
+/// Checks the file name so non-audio files never get passed to ffprobe
+fn is_audio_file(path: &path::Path) -> bool {
+    // Skip macOS resource fork files, which share the extension of the real file
+    if let Some(name) = path.file_name().and_then(|n| n.to_str()) {
+        if name.starts_with("._") {
+            return false;
+        }
+    }
+    match path.extension().and_then(|e| e.to_str()) {
+        Some(ext) => SUPPORTED_EXTENSIONS.iter().any(|s| s.eq_ignore_ascii_case(ext)),
+        None => false,
+    }
+}
+
+/// Number of top-level subdirectories above which the walk is split across threads
+const PARALLEL_WALK_THRESHOLD: usize = 4;
+/// Most threads used to walk the library
+const MAX_WALK_THREADS: usize = 8;
+/// Number of found paths that can be waiting on the probing threads
+const WALK_BUFFER: usize = 1024;
+
+/// Checks whether a directory entry is a directory.
+/// The entry's file type comes from the directory listing itself, so this avoids a stat per entry.
+/// Symlinks still need to be followed to see whether they point at a directory.
+fn is_dir_entry(e: &fs::DirEntry) -> bool {
+    match e.file_type() {
+        Ok(t) if t.is_symlink() => e.path().is_dir(),
+        Ok(t) => t.is_dir(),
+        Err(_) => e.path().is_dir(),
+    }
+}
+
+/// Iterator that walks a directory tree and yields the paths of audio files as they are found
+pub struct AudioFiles {
+    // Open listings of the directories currently being walked, deepest last
+    stack: Vec<fs::ReadDir>,
+    // Directory that is never walked into, such as the conversion output directory
+    skip_dir: Option<path::PathBuf>,
+}
+
+/// Function iterates through the directory and grabs file paths of audio files.
+/// Paths are produced lazily so conversions can start before the whole library has been walked.
+/// Nothing under `skip_dir` is listed.
+pub fn list_audio_files(dir: &path::Path, skip_dir: Option<&path::Path>) -> AudioFiles {
+    let mut stack = Vec::new();
     if dir.is_dir() {
         if let Ok(entries) = fs::read_dir(dir) {
-            // Iterate through entries in the directory
-            for entry in entries {
-                if let Ok(e) = entry {
-                    let path = e.path();
-                    // If entry is a directory, recursively search through it
-                    if path.is_dir() {
-                        build_list_of_files(path.as_path(), files);
-                    } else {
-                        // Else add file string to list
-                        if let Some(s) = path.to_str() {
-                            files.push(String::from(s));
-                        } else {
-                            log::error!("Error converting {:?} to a string", path);
-                        }
-                    }
-                } else {
-                    log::error!("I/O error while reading directory entry: {:?}", entry)
-                }
-            }
+            stack.push(entries);
         } else {
             log::error!("Error reading directory: {}", dir.display());
         }
     } else {
         log::error!("{} is not a directory!", dir.display());
     }
+    AudioFiles { stack, skip_dir: skip_dir.map(|d| d.to_path_buf()) }
+}
+
+impl Iterator for AudioFiles {
+    type Item = String;
+
+    fn next(&mut self) -> Option<String> {
+        while let Some(entries) = self.stack.last_mut() {
+            let entry = match entries.next() {
+                Some(entry) => entry,
+                // Done with this directory, go back up to its parent
+                None => {self.stack.pop(); continue;},
+            };
+            if let Ok(e) = entry {
+                let path = e.path();
+                // If entry is a directory, search through it next
+                if is_dir_entry(&e) {
+                    if self.skip_dir.as_deref() == Some(path.as_path()) {
+                        continue;
+                    }
+                    if let Ok(entries) = fs::read_dir(&path) {
+                        self.stack.push(entries);
+                    } else {
+                        log::error!("Error reading directory: {}", path.display());
+                    }
+                } else if is_audio_file(&path) {
+                    // Else hand back the audio file string
+                    if let Some(s) = path.to_str() {
+                        return Some(String::from(s));
+                    } else {
+                        log::error!("Error converting {:?} to a string", path);
+                    }
+                }
+            } else {
+                log::error!("I/O error while reading directory entry: {:?}", entry)
+            }
+        }
+        None
+    }
+}
+
+/// Walks the directory on background threads and returns an iterator over the audio files found.
+/// Libraries with more than PARALLEL_WALK_THRESHOLD top-level subdirectories (e.g. one per artist)
+/// have those subdirectories walked in parallel. Nothing under `skip_dir` is listed.
+pub fn walk_audio_files(dir: &path::Path, skip_dir: Option<&path::Path>) -> mpsc::IntoIter<String> {
+    let (sender, receiver) = mpsc::sync_channel(WALK_BUFFER);
+    let dir = dir.to_path_buf();
+    let skip_dir = skip_dir.map(|d| d.to_path_buf());
+    thread::spawn(move || walk_audio_files_into(&dir, skip_dir.as_deref(), sender));
+    receiver.into_iter()
 }
 
-// TO-DO: Implement control flow so that volumedetect is used if volume normalization is desired
-// Because volumedetect is a time-consuming process, user might not want to do it.
-// Perhaps implement concurrency to speed up conversions
-pub fn convert_song(files: Vec<String>, output_dir: &str, conversion_tag: &str) {
-    for song in files.iter().filter_map(|s| song_info::from_file(s)) {
-        match song.get_format_type() {
-            AudioFormatType::Unsupported => {log::error!("{} has an unsupported file format!", song.get_song_path()); continue;},
-            _ => {
-                let song_name;
-                match song.get_song_name() {
-                    Some(s) => {song_name = s;},
-                    None => {continue;},
+/// Sends every audio file under the directory, stopping early if the receiver is gone
+fn walk_audio_files_into(dir: &path::Path, skip_dir: Option<&path::Path>, sender: mpsc::SyncSender<String>) {
+    if !dir.is_dir() {
+        log::error!("{} is not a directory!", dir.display());
+        return;
+    }
+    let entries = match fs::read_dir(dir) {
+        Ok(entries) => entries,
+        Err(_) => {log::error!("Error reading directory: {}", dir.display()); return;},
+    };
+    // Send the top-level files right away and collect the subdirectories to split up
+    let mut subdirs = Vec::new();
+    for entry in entries {
+        if let Ok(e) = entry {
+            let path = e.path();
+            if is_dir_entry(&e) {
+                if skip_dir != Some(path.as_path()) {
+                    subdirs.push(path);
                 }
-                // If a song satisfies Rekordbox audio format, we can skip
-                if *song.get_sample_rate() <= 44100 && song.is_rekordbox_format() {
-                    match song.get_format_type() {
-                        AudioFormatType::Lossless => {if *song.get_bit_info() <= 16 {continue;}},
-                        AudioFormatType::Lossy => {if *song.get_bit_info() <= 320 {continue;}},
-                        _ => {continue;}, //can't occur since this code only gets evaluated if the format type is not unsupported
+            } else if is_audio_file(&path) {
+                if let Some(s) = path.to_str() {
+                    if sender.send(String::from(s)).is_err() {
+                        return;
                     }
+                } else {
+                    log::error!("Error converting {:?} to a string", path);
                 }
-                // If a song does not have the specified converion tag set to 1
-                // move on to the next song
-                match song.get_tags() {
-                    Some(tags) => match tags.get(conversion_tag) {
-                        // If conversion tag is not 1, skip
-                        Some(tag) => {if tag != "1" {continue;}},
-                        // If song does not have conversion tag, skip
-                        None => continue,
+            }
+        } else {
+            log::error!("I/O error while reading directory entry: {:?}", entry)
+        }
+    }
+    // Small libraries aren't worth the overhead of extra threads
+    let walkers = if subdirs.len() > PARALLEL_WALK_THRESHOLD {
+        let cores = thread::available_parallelism().map(|n| n.get()).unwrap_or(1);
+        cmp::min(MAX_WALK_THREADS, cmp::min(cores, subdirs.len()))
+    } else {
+        1
+    };
+    let queue = Mutex::new(subdirs.into_iter());
+    thread::scope(|s| {
+        for _ in 0..walkers {
+            let sender = sender.clone();
+            let queue = &queue;
+            s.spawn(move || loop {
+                let next = queue.lock().unwrap().next();
+                match next {
+                    Some(subdir) => {
+                        for file in list_audio_files(&subdir, skip_dir) {
+                            if sender.send(file).is_err() {
+                                return;
+                            }
+                        }
                     },
-                    // if song has no tags, skip
-                    None => continue,
+                    None => break,
                 }
-                let output_format;
-                let output_bit_info;
-                let output_bit_type;
-                let output_sample_rate = cmp::min(*song.get_sample_rate(), 44100);
-                let output_codec;
-                match song.get_format_type() {
-                    AudioFormatType::Lossless => {
-                        output_format = String::from("aiff");
-                        output_bit_type = "-sample_fmt";
-                        output_bit_info = format!("s{}", cmp::min(*song.get_bit_info(), 16));
-                        output_codec = String::from("pcm_s16le");
-                    },
-                    AudioFormatType::Lossy => {
-                        output_format = String::from("mp3");
-                        output_bit_type = "-audio_bitrate";
-                        output_bit_info = format!("{}", cmp::min(*song.get_bit_info(), 320000));
-                        output_codec = String::from("mp3");
+            });
+        }
+    });
+}
+
+/// Peak volume in dB that songs are normalized to
+const PEAK_DB: f64 = -1.0;
+
+/// Builds the ffmpeg filter that brings a song with the given peak volume to PEAK_DB
+pub fn peak_volume_filter(max_volume: f64) -> Option<String> {
+    let offset = PEAK_DB - max_volume;
+    if offset != 0.0 {
+        Some(format!("volume={}dB", offset))
+    } else {
+        None
+    }
+}
+
+/// Settings shared by every conversion in a run
+pub struct ConversionOptions {
+    /// Directory the songs were found in, whose folder layout is mirrored in the output directory
+    pub input_dir: path::PathBuf,
+    pub output_dir: String,
+    pub conversion_tag: String,
+    /// Number of threads each local ffmpeg process may use
+    pub threads: usize,
+    /// Whether to normalize the peak volume of converted songs to PEAK_DB
+    pub normalize: bool,
+    /// Other machines reachable over ssh that also take conversions, each running up to its slot count at once
+    pub remote_hosts: Vec<RemoteHost>,
+}
+
+/// Converts every file from the iterator, running up to `jobs` conversions at once.
+/// Each ffmpeg process is capped at `options.threads` threads, so jobs * threads should be about the core count.
+/// Probing mostly waits on ffprobe, so twice as many threads probe files and pass the songs
+/// that need converting on to the conversion threads. Each remote host adds one conversion thread per slot.
+pub fn convert_songs(files: impl Iterator<Item = String> + Send, options: &ConversionOptions, jobs: usize) {
+    let jobs = cmp::max(jobs, 1);
+    let queue = Mutex::new(files);
+    // Bounded so probing can't run too far ahead of conversion
+    let (sender, receiver) = mpsc::sync_channel::<SongInfo>(jobs);
+    let receiver = Mutex::new(receiver);
+    thread::scope(|s| {
+        for _ in 0..jobs * 2 {
+            let sender = sender.clone();
+            let queue = &queue;
+            s.spawn(move || loop {
+                // Only hold the lock long enough to grab the next file
+                let next = queue.lock().unwrap().next();
+                match next {
+                    Some(path) => {
+                        if let Some(song) = probe_song(&path, options) {
+                            if sender.send(song).is_err() {
+                                break;
+                            }
+                        }
                     },
-                    _ => {continue;}, //can't occur as this code block only gets evaluated if the audio format is not unsupported
+                    None => break,
                 }
-                let convert_output = Command::new("ffmpeg")
-                    .arg("-y")
-                    .arg("-i")
-                    .arg(song.get_song_path())
-                    .arg("-acodec")
-                    .arg(output_codec)
-                    .arg("-ar")
-                    .arg(format!("{}", output_sample_rate))
-                    .arg("-write_id3v2")
-                    .arg("1")
-                    .arg("-metadata")
-                    .arg("REKORDBOX_READY=1")
-                    .arg("-metadata")
-                    .arg("CONVERT_FOR_REKORDBOX=0")
-                    .arg(output_bit_type)
-                    .arg(output_bit_info)
-                    .arg(format!("{}/{}.{}", output_dir, song_name, output_format))
-                    .output();
-                // If we ran into an error when converting the file, log it and then move on to the next file
-                match convert_output {
-                    Ok(o) => {
-                        if !o.status.success() {
-                            log::error!("Error with converting {}", song.get_song_path());
-                            io::stderr().write_all(&o.stderr).unwrap();
-                            continue;
+            });
+        }
+        // Conversion threads stop once every probing thread has dropped its sender
+        drop(sender);
+        // Whichever worker is free takes the next song, local or remote
+        let local_workers = (0..jobs).map(|_| None);
+        let remote_workers = options.remote_hosts.iter().flat_map(|h| (0..h.slots).map(move |_| Some(h)));
+        for host in local_workers.chain(remote_workers) {
+            let receiver = &receiver;
+            s.spawn(move || loop {
+                let next = receiver.lock().unwrap().recv();
+                match next {
+                    Ok(song) => {
+                        if !convert_song(&song, options, host) {
+                            break;
                         }
                     },
-                    Err(e) => {
-                        log::error!("Error with converting {}: {}", song.get_song_path(), e);
-                        continue;   
-                    },
+                    Err(_) => break,
+                }
+            });
+        }
+    });
+}
+
+/// Probes a file, returning the song only if it needs to be converted.
+/// Only metadata from ffprobe is used here, so the expensive volume measurement
+/// is never run for songs that get filtered out.
+pub fn probe_song(path: &str, options: &ConversionOptions) -> Option<SongInfo> {
+    let song = song_info::from_file(path)?;
+    if needs_conversion(&song, options) {
+        Some(song)
+    } else {
+        None
+    }
+}
+
+/// Decides from a song's tags and format whether it should be converted
+fn needs_conversion(song: &SongInfo, options: &ConversionOptions) -> bool {
+    match song.get_format_type() {
+        AudioFormatType::Unsupported => {log::error!("{} has an unsupported file format!", song.get_song_path()); return false;},
+        _ => {
+            // Converted songs are tagged as ready, so they are skipped if they end up back in the input directory
+            if song.get_tag("REKORDBOX_READY") == Some("1") {
+                return false;
+            }
+            // Check the conversion tag before the format, since most of a library usually isn't tagged for conversion.
+            // If a song does not have the specified converion tag set to 1 (or has no tags at all)
+            // move on to the next song
+            if song.get_tag(&options.conversion_tag) != Some("1") {
+                return false;
+            }
+            // If a song satisfies Rekordbox audio format, we can skip
+            if *song.get_sample_rate() <= 44100 && song.is_rekordbox_format() {
+                match song.get_format_type() {
+                    AudioFormatType::Lossless => {if *song.get_bit_info() <= 16 {return false;}},
+                    AudioFormatType::Lossy => {if *song.get_bit_info() <= 320 {return false;}},
+                    _ => {return false;}, //can't occur since this code only gets evaluated if the format type is not unsupported
                 }
             }
         }
     }
+    true
 }
 
+/// Converts a song that was returned by probe_song into the output directory,
+/// either locally or on the given remote host.
+/// If the remote host can't be reached, the song is converted locally instead and false is returned,
+/// so the host's worker stops taking songs.
+pub fn convert_song(song: &SongInfo, options: &ConversionOptions, host: Option<&RemoteHost>) -> bool {
+    let song_name;
+    match song.get_song_name() {
+        Some(s) => {song_name = s;},
+        None => {return true;},
+    }
+    let output_sample_rate = cmp::min(*song.get_sample_rate(), 44100);
+    // The format, codec and bit option are fixed per format type, so only the bit info is built per song
+    let (output_format, output_codec, output_bit_type, output_bit_info) = match song.get_format_type() {
+        AudioFormatType::Lossless => ("aiff", "pcm_s16le", "-sample_fmt", format!("s{}", cmp::min(*song.get_bit_info(), 16))),
+        AudioFormatType::Lossy => ("mp3", "mp3", "-audio_bitrate", format!("{}", cmp::min(*song.get_bit_info(), 320000))),
+        _ => {return true;}, //can't occur as probe_song filters out unsupported audio formats
+    };
+    let output_path = output_path(song.get_song_path(), song_name, output_format, options);
+    // Sources keep their conversion tag, so reruns skip songs whose output is already newer than the source
+    if is_up_to_date(song.get_song_path(), &output_path) {
+        log::info!("{} is already converted, skipping", song.get_song_path());
+        return true;
+    }
+    if let Some(dir) = path::Path::new(&output_path).parent() {
+        if let Err(e) = fs::create_dir_all(dir) {
+            log::error!("Could not create output directory {}: {}", dir.display(), e);
+            return true;
+        }
+    }
+    // Volume is only measured once we know the song is being converted,
+    // since volumedetect has to decode the whole file. Remote hosts measure their own copy
+    // so that decode doesn't run here, unless a ReplayGain tag already gives the peak.
+    let mut volume_filter = None;
+    let mut measure_remotely = false;
+    if options.normalize {
+        let max_volume = match host {
+            Some(_) => song.get_replaygain_peak(),
+            None => song.get_max_volume(),
+        };
+        match max_volume {
+            Some(max_volume) => {volume_filter = peak_volume_filter(max_volume);},
+            None if host.is_some() => {measure_remotely = true;},
+            None => log::error!("Could not measure volume of {}, converting without normalizing", song.get_song_path()),
+        }
+    }
+    // Everything between the input and output file, shared by local and remote conversions
+    let mut ffmpeg_options = Vec::new();
+    if let Some(filter) = volume_filter {
+        ffmpeg_options.push(String::from("-filter:a"));
+        ffmpeg_options.push(filter);
+    }
+    ffmpeg_options.extend(vec![
+        String::from("-acodec"),
+        String::from(output_codec),
+        String::from("-ar"),
+        format!("{}", output_sample_rate),
+        String::from("-write_id3v2"),
+        String::from("1"),
+        String::from("-metadata"),
+        String::from("REKORDBOX_READY=1"),
+        String::from("-metadata"),
+        String::from("CONVERT_FOR_REKORDBOX=0"),
+        String::from(output_bit_type),
+        output_bit_info,
+        // The format is given explicitly since the partial output's extension doesn't name it
+        String::from("-f"),
+        String::from(output_format),
+    ]);
+    // ffmpeg writes next to the output and the result is renamed into place once it's complete,
+    // so an interrupted conversion never leaves a file that looks up to date
+    let partial_path = format!("{}.part", output_path);
+    let mut host_down = false;
+    let convert_output = match host {
+        Some(h) => match remote::convert(h, song.get_song_path(), ffmpeg_options.clone(), &partial_path, output_format, measure_remotely) {
+            Err(e) if remote::is_host_down(&e) => {
+                log::error!("{} is unreachable, converting {} locally and sending it no more songs: {}", h.host, song.get_song_path(), e);
+                host_down = true;
+                if measure_remotely {
+                    match song.get_max_volume() {
+                        Some(max_volume) => {
+                            if let Some(filter) = peak_volume_filter(max_volume) {
+                                ffmpeg_options.insert(0, filter);
+                                ffmpeg_options.insert(0, String::from("-filter:a"));
+                            }
+                        },
+                        None => log::error!("Could not measure volume of {}, converting without normalizing", song.get_song_path()),
+                    }
+                }
+                ffmpeg_local(song.get_song_path(), &ffmpeg_options, options.threads, &partial_path)
+            },
+            result => result,
+        },
+        None => ffmpeg_local(song.get_song_path(), &ffmpeg_options, options.threads, &partial_path),
+    };
+    // If we ran into an error when converting the file, log it and then move on to the next file
+    match convert_output {
+        Ok(o) => {
+            if !o.status.success() {
+                // Log ffmpeg's output as part of the same message so it doesn't interleave with other workers
+                log::error!("Error with converting {}:\n{}", song.get_song_path(), String::from_utf8_lossy(&o.stderr));
+                let _ = fs::remove_file(&partial_path);
+                return !host_down;
+            }
+        },
+        Err(e) => {
+            log::error!("Error with converting {}: {}", song.get_song_path(), e);
+            let _ = fs::remove_file(&partial_path);
+            return !host_down;
+        },
+    }
+    if let Err(e) = fs::rename(&partial_path, &output_path) {
+        log::error!("Could not move {} to {}: {}", partial_path, output_path, e);
+    }
+    !host_down
+}
 
-// Helper function to find the peak RMS of an audio file
-fn get_max_volume(path: &str) -> Option<f64> {
-    let output = Command::new("ffmpeg")
+/// Runs ffmpeg on this machine with the output options built by convert_song
+fn ffmpeg_local(song_path: &str, ffmpeg_options: &[String], threads: usize, output_path: &str) -> io::Result<Output> {
+    Command::new("ffmpeg")
+        .arg("-y")
         .arg("-i")
-        .arg(path)
-        .arg("-filter:a")
-        .arg("volumedetect")
-        .arg("-f")
-        .arg("null")
-        .arg("dummy.mp3") //dummy output that ffmpeg requires
+        .arg(song_path)
+        .args(ffmpeg_options)
+        .arg("-threads")
+        .arg(format!("{}", threads))
+        .arg(output_path)
         .output()
-        .expect("failed to get volume");
-    let mut max_volume = None;
-    let vol_output = String::from_utf8(output.stderr);
-    if let Ok(vol_output) = vol_output {
-        // Find the line with max volume
-        let line: String = vol_output
-            .lines()
-            .filter(|s| s.ends_with("dB"))
-            .filter(|s| s.contains("max_volume"))
-            .collect();
-        // Parse the max volume line to find the level
-        let mut parsed_num: Vec<f64> = line
-            .split(' ')
-            .filter_map(|s| s.parse::<f64>().ok())
-            .collect();
-        if parsed_num.len() != 1 {
-            log::error!("Volume for {} not parsed correctly!", path);
-        } else {
-            max_volume = parsed_num.pop();
-        }
-    } else {
-        log::error!("Could not parse output from volumedetect for {}", path);
+}
+
+/// Checks whether a song's output was written after the source last changed
+fn is_up_to_date(song_path: &str, output_path: &str) -> bool {
+    let modified = |p: &str| fs::metadata(p).and_then(|m| m.modified()).ok();
+    match (modified(song_path), modified(output_path)) {
+        (Some(source), Some(output)) => output >= source,
+        _ => false,
     }
-    max_volume
+}
+
+
+/// Builds the output path of a song from its source path alone, so parallel conversions never write
+/// the same file and every run picks the same name. The song's folder under the input directory is
+/// mirrored in the output directory, which keeps songs with the same name in different folders apart.
+/// If the folder also holds another audio file with the same name, such as a FLAC and a WAV of one
+/// track, the source extension is added to the name, e.g. "01 Intro (wav).aiff".
+fn output_path(song_path: &str, song_name: &str, output_format: &str, options: &ConversionOptions) -> String {
+    let source = path::Path::new(song_path);
+    let folder = source.parent().unwrap_or(path::Path::new(""));
+    let output_folder = match folder.strip_prefix(&options.input_dir) {
+        Ok(relative) => path::Path::new(&options.output_dir).join(relative),
+        Err(_) => path::PathBuf::from(&options.output_dir),
+    };
+    let has_namesake = fs::read_dir(folder).map(|entries| entries.filter_map(|e| e.ok()).any(|e| {
+        let other = e.path();
+        other != source && is_audio_file(&other) && other.file_stem().and_then(|s| s.to_str()) == Some(song_name)
+    })).unwrap_or(false);
+    let file_name = match source.extension().and_then(|e| e.to_str()) {
+        Some(ext) if has_namesake => format!("{} ({}).{}", song_name, ext, output_format),
+        _ => format!("{}.{}", song_name, output_format),
+    };
+    output_folder.join(file_name).to_string_lossy().into_owned()
+}
+
+fn print_usage() {
+    eprintln!("Usage: rekordbox-file-conversion <input_dir> <output_dir> [--tag TAG] [--jobs N] [--normalize] [--workers HOST[:SLOTS],...]");
 }
 
 fn main() {
     env_logger::init();
-    let mut test_vec = Vec::new();
-    test_vec.push(String::from("/home/kevlu93/Music/Rufus and Chaka - Body Heat (copy).flac"));
-    convert_song(test_vec, "/home/kevlu93/Music/file_conversion_test_output/","CONVERT_FOR_REKORDBOX");
-    println!("{:?}", song_info::from_file("/home/kevlu93/Music/file_conversion_test_output/Rufus and Chaka - Body Heat (copy).aiff").unwrap());
+    let args: Vec<String> = env::args().skip(1).collect();
+    let mut dirs = Vec::new();
+    let mut conversion_tag = String::from("CONVERT_FOR_REKORDBOX");
+    // Default to one conversion per core
+    let cores = thread::available_parallelism().map(|n| n.get()).unwrap_or(1);
+    let mut jobs = cores;
+    let mut normalize = false;
+    let mut remote_hosts = Vec::new();
+    let mut iter = args.iter();
+    while let Some(arg) = iter.next() {
+        match arg.as_str() {
+            "--tag" => match iter.next() {
+                Some(t) => {conversion_tag = t.clone();},
+                None => {print_usage(); process::exit(1);},
+            },
+            "--jobs" => match iter.next().and_then(|n| n.parse::<usize>().ok()) {
+                Some(n) if n > 0 => {jobs = n;},
+                _ => {print_usage(); process::exit(1);},
+            },
+            "--normalize" => {normalize = true;},
+            "--workers" => match iter.next() {
+                Some(h) => match h.split(',').map(remote::parse_host).collect::<Option<Vec<RemoteHost>>>() {
+                    Some(hosts) => {remote_hosts = hosts;},
+                    None => {print_usage(); process::exit(1);},
+                },
+                None => {print_usage(); process::exit(1);},
+            },
+            _ => dirs.push(arg.clone()),
+        }
+    }
+    if dirs.len() != 2 {
+        print_usage();
+        process::exit(1);
+    }
+    let output_dir = &dirs[1];
+    if let Err(e) = fs::create_dir_all(output_dir) {
+        log::error!("Could not create output directory {}: {}", output_dir, e);
+        process::exit(1);
+    }
+    // Canonical paths let the walk recognize the output directory if it is inside the input directory,
+    // so converted songs are skipped without being probed
+    let (input_dir, output_dir_path) = match (fs::canonicalize(&dirs[0]), fs::canonicalize(output_dir)) {
+        (Ok(i), Ok(o)) => (i, o),
+        _ => {
+            log::error!("Could not resolve {} or {}", dirs[0], output_dir);
+            process::exit(1);
+        }
+    };
+    // Remote hosts split their own cores between their slots. They are all asked at once so one slow host
+    // doesn't hold up the start of the run, and hosts that can't be reached are left out.
+    let remote_hosts: Vec<RemoteHost> = thread::scope(|s| {
+        let probes: Vec<_> = remote_hosts
+            .into_iter()
+            .map(|mut h| s.spawn(move || if h.detect_threads() { Some(h) } else { None }))
+            .collect();
+        probes.into_iter().filter_map(|p| p.join().ok().flatten()).collect()
+    });
+    // Split the cores between the jobs so parallel ffmpeg processes don't oversubscribe the CPU
+    let options = ConversionOptions {
+        output_dir: output_dir.clone(),
+        conversion_tag,
+        threads: cmp::max(1, cores / jobs),
+        normalize,
+        remote_hosts,
+        input_dir,
+    };
+    // The walk runs on its own threads, so scanning overlaps with probing and conversion
+    convert_songs(walk_audio_files(&options.input_dir, Some(&output_dir_path)), &options, jobs);
+    probe_cache::save(&options.input_dir);
 }
 
 #[cfg(test)]
@@ -177,8 +541,115 @@ mod tests {
     use super::*;
 
     #[test]
-    fn test_get_volume() {
-        assert_eq!(get_max_volume("/home/klu/Music/Hanna - Intercession, On Behalf.flac").unwrap(), -1.0);
-        assert!(get_max_volume("dummy.mp3").is_none());
+    fn test_is_audio_file() {
+        assert!(is_audio_file(path::Path::new("/home/klu/Music/song.flac")));
+        assert!(is_audio_file(path::Path::new("/home/klu/Music/01.Intro.MP3")));
+        assert!(!is_audio_file(path::Path::new("/home/klu/Music/cover.jpg")));
+        assert!(!is_audio_file(path::Path::new("/home/klu/Music/._song.flac")));
+        assert!(!is_audio_file(path::Path::new("/home/klu/Music/flac")));
+    }
+
+    #[test]
+    fn test_list_audio_files() {
+        let dir = env::temp_dir().join("rekordbox_list_audio_files_test");
+        fs::create_dir_all(dir.join("Artist").join("Album")).unwrap();
+        fs::write(dir.join("single.mp3"), b"").unwrap();
+        fs::write(dir.join("Artist").join("Album").join("01 Track.flac"), b"").unwrap();
+        fs::write(dir.join("Artist").join("Album").join("cover.jpg"), b"").unwrap();
+
+        let mut files: Vec<String> = list_audio_files(&dir, None).collect();
+        files.sort();
+        assert_eq!(2, files.len());
+        assert!(files[0].ends_with("01 Track.flac"));
+        assert!(files[1].ends_with("single.mp3"));
+        assert_eq!(1, list_audio_files(&dir, Some(&dir.join("Artist").join("Album"))).count());
+
+        fs::remove_dir_all(&dir).unwrap();
+        assert_eq!(0, list_audio_files(&dir, None).count());
+    }
+
+    #[test]
+    fn test_walk_audio_files_in_parallel() {
+        let dir = env::temp_dir().join("rekordbox_walk_audio_files_test");
+        for i in 0..PARALLEL_WALK_THRESHOLD + 2 {
+            let artist = dir.join(format!("Artist {}", i));
+            fs::create_dir_all(&artist).unwrap();
+            fs::write(artist.join("track.flac"), b"").unwrap();
+        }
+        fs::write(dir.join("single.mp3"), b"").unwrap();
+
+        assert_eq!(PARALLEL_WALK_THRESHOLD + 3, walk_audio_files(&dir, None).count());
+        assert_eq!(PARALLEL_WALK_THRESHOLD + 2, walk_audio_files(&dir, Some(&dir.join("Artist 0"))).count());
+        fs::remove_dir_all(&dir).unwrap();
+    }
+
+    fn test_options(input_dir: path::PathBuf) -> ConversionOptions {
+        ConversionOptions {
+            input_dir,
+            output_dir: String::from("out"),
+            conversion_tag: String::from("CONVERT_FOR_REKORDBOX"),
+            threads: 1,
+            normalize: false,
+            remote_hosts: Vec::new(),
+        }
+    }
+
+    #[test]
+    fn test_output_path() {
+        let dir = env::temp_dir().join("rekordbox_output_path_test");
+        for album in ["Album A", "Album B"] {
+            fs::create_dir_all(dir.join(album)).unwrap();
+            fs::write(dir.join(album).join("01 Intro.flac"), b"").unwrap();
+        }
+        fs::write(dir.join("Album B").join("02 Outro.flac"), b"").unwrap();
+        fs::write(dir.join("Album B").join("02 Outro.wav"), b"").unwrap();
+        fs::write(dir.join("Album B").join("02 Outro.jpg"), b"").unwrap();
+        let options = test_options(dir.clone());
+        let song_path = |album: &str, file: &str| dir.join(album).join(file).to_string_lossy().into_owned();
+
+        assert_eq!("out/Album A/01 Intro.aiff", output_path(&song_path("Album A", "01 Intro.flac"), "01 Intro", "aiff", &options));
+        assert_eq!("out/Album B/01 Intro.aiff", output_path(&song_path("Album B", "01 Intro.flac"), "01 Intro", "aiff", &options));
+        assert_eq!("out/Album B/02 Outro (flac).aiff", output_path(&song_path("Album B", "02 Outro.flac"), "02 Outro", "aiff", &options));
+        assert_eq!("out/Album B/02 Outro (wav).aiff", output_path(&song_path("Album B", "02 Outro.wav"), "02 Outro", "aiff", &options));
+        fs::remove_dir_all(&dir).unwrap();
+    }
+
+    #[test]
+    fn test_is_up_to_date() {
+        let source = env::temp_dir().join("rekordbox_up_to_date_test.flac");
+        let output = env::temp_dir().join("rekordbox_up_to_date_test.aiff");
+        fs::write(&source, b"").unwrap();
+        let _ = fs::remove_file(&output);
+        assert!(!is_up_to_date(source.to_str().unwrap(), output.to_str().unwrap()));
+
+        fs::write(&output, b"").unwrap();
+        assert!(is_up_to_date(source.to_str().unwrap(), output.to_str().unwrap()));
+        fs::remove_file(&source).unwrap();
+        assert!(!is_up_to_date(source.to_str().unwrap(), output.to_str().unwrap()));
+        fs::remove_file(&output).unwrap();
+    }
+
+    #[test]
+    fn test_needs_conversion() {
+        use song_info::tests::{flac_song_info, lossless_song_info};
+        let options = test_options(path::PathBuf::from("."));
+        let tagged = serde_json::json!({"CONVERT_FOR_REKORDBOX": "1"});
+        assert!(needs_conversion(&flac_song_info(Some(tagged.clone())), &options));
+
+        // Already converted
+        let ready = serde_json::json!({"CONVERT_FOR_REKORDBOX": "1", "REKORDBOX_READY": "1"});
+        assert!(!needs_conversion(&flac_song_info(Some(ready)), &options));
+        // Not tagged for conversion
+        assert!(!needs_conversion(&flac_song_info(Some(serde_json::json!({"CONVERT_FOR_REKORDBOX": "0"}))), &options));
+        assert!(!needs_conversion(&flac_song_info(None), &options));
+        // Already in a Rekordbox format
+        assert!(!needs_conversion(&lossless_song_info("aiff", Some(tagged)), &options));
+    }
+
+    #[test]
+    fn test_peak_volume_filter() {
+        assert_eq!(Some(String::from("volume=-2dB")), peak_volume_filter(1.0));
+        assert_eq!(Some(String::from("volume=4.5dB")), peak_volume_filter(-5.5));
+        assert_eq!(None, peak_volume_filter(PEAK_DB));
     }
 }
@@ -0,0 +1,192 @@
+use serde::{Deserialize, Serialize};
+use std::collections::HashMap;
+use std::sync::{Mutex, OnceLock};
+use std::time::{Duration, Instant, UNIX_EPOCH};
+use std::{cmp, env, fs, path};
+
+/// Cached ffprobe output for a file, along with the file stats it was taken from
+#[derive(Deserialize, Serialize)]
+struct CacheEntry {
+    mtime_ns: u64,
+    size: u64,
+    probe: serde_json::Value,
+}
+
+/// Fewest new probes that trigger writing the cache out during a run
+const FLUSH_MIN: usize = 100;
+/// Longest time new probes wait before being written out, so an interrupted run keeps its work
+const FLUSH_INTERVAL: Duration = Duration::from_secs(60);
+
+/// In-memory copy of the on-disk probe cache, keyed by file path
+struct ProbeCache {
+    entries: HashMap<String, CacheEntry>,
+    // Probes added since the cache was last written
+    unsaved: usize,
+    last_write: Instant,
+}
+
+impl ProbeCache {
+    /// The whole file is rewritten on every flush, so the number of probes between flushes grows with
+    /// the size of the cache. That keeps the total written during a run linear in the number of probes.
+    fn should_flush(&self) -> bool {
+        self.unsaved >= cmp::max(FLUSH_MIN, self.entries.len() / 4)
+            || (self.unsaved > 0 && self.last_write.elapsed() >= FLUSH_INTERVAL)
+    }
+}
+
+static CACHE: OnceLock<Mutex<ProbeCache>> = OnceLock::new();
+// Held while the cache file is written, so flushes happen one at a time and in order
+static WRITE_LOCK: Mutex<()> = Mutex::new(());
+
+/// Location of the cache file, following the XDG cache directory convention
+fn cache_file() -> Option<path::PathBuf> {
+    let cache_dir = match env::var_os("XDG_CACHE_HOME") {
+        Some(d) => path::PathBuf::from(d),
+        None => path::PathBuf::from(env::var_os("HOME")?).join(".cache"),
+    };
+    Some(cache_dir.join("rekordbox-file-conversion").join("probe.json"))
+}
+
+/// Lazily loads the cache from disk the first time it is needed
+fn cache() -> &'static Mutex<ProbeCache> {
+    CACHE.get_or_init(|| {
+        let entries = cache_file()
+            .and_then(|f| fs::read(f).ok())
+            .and_then(|b| serde_json::from_slice(&b).ok())
+            .unwrap_or_default();
+        Mutex::new(ProbeCache { entries, unsaved: 0, last_write: Instant::now() })
+    })
+}
+
+/// Returns the modification time in nanoseconds and size of a file
+fn file_stats(path: &str) -> Option<(u64, u64)> {
+    let metadata = fs::metadata(path).ok()?;
+    let mtime = metadata.modified().ok()?.duration_since(UNIX_EPOCH).ok()?;
+    Some((mtime.as_nanos() as u64, metadata.len()))
+}
+
+/// Returns the cached probe for a file if the file hasn't changed since it was probed
+pub fn get(path: &str) -> Option<serde_json::Value> {
+    let (mtime_ns, size) = file_stats(path)?;
+    let cache = cache().lock().unwrap();
+    match cache.entries.get(path) {
+        Some(e) if e.mtime_ns == mtime_ns && e.size == size => Some(e.probe.clone()),
+        _ => None,
+    }
+}
+
+/// Stores the probe for a file in the cache
+pub fn insert(path: &str, probe: serde_json::Value) {
+    if let Some((mtime_ns, size)) = file_stats(path) {
+        let flush = {
+            let mut cache = cache().lock().unwrap();
+            cache.entries.insert(String::from(path), CacheEntry { mtime_ns, size, probe });
+            cache.unsaved += 1;
+            cache.should_flush()
+        };
+        if flush {
+            // Skip this flush if another thread is already writing, it will be picked up by the next one
+            if let Ok(_writing) = WRITE_LOCK.try_lock() {
+                write();
+            }
+        }
+    }
+}
+
+/// Removes entries under `root` for files that no longer exist, returning whether any were removed.
+/// Entries elsewhere are kept, since their drive may just not be mounted right now.
+fn prune_missing(entries: &mut HashMap<String, CacheEntry>, root: &path::Path) -> bool {
+    let before = entries.len();
+    entries.retain(|p, _| !path::Path::new(p).starts_with(root) || fs::metadata(p).is_ok());
+    entries.len() != before
+}
+
+/// Writes the cache back to disk at the end of a run, dropping entries for files deleted from `root`
+pub fn save(root: &path::Path) {
+    let cache = match CACHE.get() {
+        Some(c) => c,
+        None => return,
+    };
+    let _writing = WRITE_LOCK.lock().unwrap();
+    let needs_write = {
+        let mut cache = cache.lock().unwrap();
+        let pruned = prune_missing(&mut cache.entries, root);
+        pruned || cache.unsaved > 0
+    };
+    if needs_write {
+        write();
+    }
+}
+
+/// Writes the cache to disk. Callers must hold WRITE_LOCK.
+/// The cache is only locked while it is serialized, so probing threads aren't held up by the file write.
+fn write() {
+    let file = match cache_file() {
+        Some(f) => f,
+        None => {log::error!("Could not determine a cache directory for the probe cache"); return;},
+    };
+    if let Some(dir) = file.parent() {
+        if let Err(e) = fs::create_dir_all(dir) {
+            log::error!("Could not create cache directory {}: {}", dir.display(), e);
+            return;
+        }
+    }
+    let (bytes, saved) = {
+        let mut cache = cache().lock().unwrap();
+        let bytes = serde_json::to_vec(&cache.entries);
+        let saved = cache.unsaved;
+        cache.unsaved = 0;
+        cache.last_write = Instant::now();
+        (bytes, saved)
+    };
+    // Write to a temporary file first so a crash can't leave a half-written cache behind
+    let tmp_file = file.with_extension("json.tmp");
+    let result = bytes
+        .map_err(|e| e.into())
+        .and_then(|b| fs::write(&tmp_file, b))
+        .and_then(|_| fs::rename(&tmp_file, &file));
+    if let Err(e) = result {
+        log::error!("Could not write probe cache to {}: {}", file.display(), e);
+        // Count the probes as unsaved again so the next flush retries them
+        cache().lock().unwrap().unsaved += saved;
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_cache_invalidated_when_file_changes() {
+        let file = env::temp_dir().join("rekordbox_probe_cache_test.mp3");
+        let path = file.to_str().unwrap();
+        fs::write(&file, b"abc").unwrap();
+        assert!(get(path).is_none());
+
+        insert(path, serde_json::json!({"format": {"format_name": "mp3"}}));
+        assert_eq!("mp3", get(path).unwrap()["format"]["format_name"]);
+
+        fs::write(&file, b"abcd").unwrap();
+        assert!(get(path).is_none());
+        fs::remove_file(&file).unwrap();
+    }
+
+    #[test]
+    fn test_prune_missing() {
+        let file = env::temp_dir().join("rekordbox_probe_cache_prune_test.mp3");
+        fs::write(&file, b"abc").unwrap();
+        let mut entries = HashMap::new();
+        let missing = env::temp_dir().join("rekordbox_probe_cache_missing.mp3");
+        for p in [file.to_str().unwrap(), missing.to_str().unwrap(), "/unmounted/song.mp3"] {
+            entries.insert(String::from(p), CacheEntry { mtime_ns: 0, size: 0, probe: serde_json::Value::Null });
+        }
+
+        assert!(prune_missing(&mut entries, &env::temp_dir()));
+        assert!(entries.contains_key(file.to_str().unwrap()));
+        // Files outside the library being converted are kept even though they can't be found
+        assert!(entries.contains_key("/unmounted/song.mp3"));
+        assert_eq!(2, entries.len());
+        assert!(!prune_missing(&mut entries, &env::temp_dir()));
+        fs::remove_file(&file).unwrap();
+    }
+}
@@ -0,0 +1,236 @@
+use std::io;
+use std::{cmp, path};
+use std::process::{Command, Output};
+use crate::song_info;
+
+/// A machine that takes conversions over ssh
+pub struct RemoteHost {
+    pub host: String,
+    /// Number of conversions the host runs at once
+    pub slots: usize,
+    /// Threads each ffmpeg process on the host may use, split from the host's own core count
+    pub threads: Option<usize>,
+}
+
+/// Parses a host given as "host" or "host:slots". Hosts default to a single slot.
+/// IPv6 addresses should be given through an ssh config alias, since they contain colons.
+pub fn parse_host(spec: &str) -> Option<RemoteHost> {
+    let (host, slots) = match spec.rsplit_once(':') {
+        Some((host, slots)) => (host, slots.parse::<usize>().ok().filter(|n| *n > 0)?),
+        None => (spec, 1),
+    };
+    if host.is_empty() {
+        return None;
+    }
+    Some(RemoteHost { host: String::from(host), slots, threads: None })
+}
+
+impl RemoteHost {
+    /// Asks the host how many cores it has so ffmpeg threads can be split between its slots.
+    /// If the host answers but its core count can't be read, ffmpeg on the host picks its own thread count.
+    /// Returns false if the host can't be reached at all.
+    pub fn detect_threads(&mut self) -> bool {
+        let output = match ssh(&self.host, "nproc") {
+            Ok(o) if !is_transport_failure(&o) => o,
+            Ok(o) => {
+                log::error!("Could not reach {}, converting without it:\n{}", self.host, String::from_utf8_lossy(&o.stderr));
+                return false;
+            },
+            Err(e) => {
+                log::error!("Could not reach {}, converting without it: {}", self.host, e);
+                return false;
+            },
+        };
+        let cores = Some(output)
+            .filter(|o| o.status.success())
+            .and_then(|o| String::from_utf8_lossy(&o.stdout).trim().parse::<usize>().ok());
+        match cores {
+            Some(n) => {self.threads = Some(cmp::max(1, n / self.slots));},
+            None => log::warn!("Could not get the core count of {}, letting ffmpeg choose its threads", self.host),
+        }
+        true
+    }
+}
+
+/// Gives up on connecting to an unresponsive host instead of waiting on TCP timeouts
+const CONNECT_TIMEOUT: &str = "ConnectTimeout=10";
+
+/// ssh and scp exit with 255 when the connection itself fails, as opposed to the remote command failing
+fn is_transport_failure(output: &Output) -> bool {
+    output.status.code() == Some(255)
+}
+
+/// Wraps an argument in single quotes so the remote shell passes it to ffmpeg unchanged
+fn shell_quote(arg: &str) -> String {
+    format!("'{}'", arg.replace('\'', "'\\''"))
+}
+
+/// scp treats anything with a colon before the first slash as host:path, so local paths are made explicit
+fn local_scp_path(p: &str) -> String {
+    if path::Path::new(p).is_absolute() {
+        String::from(p)
+    } else {
+        format!("./{}", p)
+    }
+}
+
+/// Turns a failed connection into a NotConnected error, so callers can tell a host that went down
+/// apart from a conversion that failed on it
+fn connected(host: &str, output: io::Result<Output>) -> io::Result<Output> {
+    match output {
+        Ok(o) if is_transport_failure(&o) => Err(io::Error::new(
+            io::ErrorKind::NotConnected,
+            format!("lost connection to {}: {}", host, String::from_utf8_lossy(&o.stderr).trim()),
+        )),
+        Ok(o) => Ok(o),
+        Err(e) => Err(io::Error::new(io::ErrorKind::NotConnected, format!("could not run ssh or scp: {}", e))),
+    }
+}
+
+/// Checks whether an error from convert means the host can't be reached anymore
+pub fn is_host_down(e: &io::Error) -> bool {
+    e.kind() == io::ErrorKind::NotConnected
+}
+
+/// Runs a command on the host over ssh without ever prompting for a password
+fn ssh(host: &str, command: &str) -> io::Result<Output> {
+    Command::new("ssh")
+        .arg("-o")
+        .arg("BatchMode=yes")
+        .arg("-o")
+        .arg(CONNECT_TIMEOUT)
+        .arg(host)
+        .arg(command)
+        .output()
+}
+
+/// Copies a file to or from a host with scp, using the same options as ssh
+fn scp(from: &str, to: &str) -> io::Result<Output> {
+    Command::new("scp")
+        .arg("-q")
+        .arg("-o")
+        .arg("BatchMode=yes")
+        .arg("-o")
+        .arg(CONNECT_TIMEOUT)
+        .arg(from)
+        .arg(to)
+        .output()
+}
+
+/// Runs volumedetect on the host's copy of a song and parses the peak volume from its output
+fn remote_max_volume(host: &str, remote_input: &str) -> Option<f64> {
+    let mut command = String::from("ffmpeg");
+    for arg in song_info::volumedetect_args(remote_input) {
+        command.push(' ');
+        command.push_str(&shell_quote(&arg));
+    }
+    let output = ssh(host, &command).ok()?;
+    String::from_utf8_lossy(&output.stderr).lines().rev().find_map(song_info::parse_max_volume)
+}
+
+/// Converts a song with ffmpeg on another machine.
+/// The input is copied into a temporary directory on the host, converted there with the same
+/// output options as a local conversion, and the result is copied back to `output_path`.
+/// With `measure_volume`, the host also measures the peak volume of its copy and normalizes it,
+/// so the volumedetect decode runs there instead of on this machine.
+/// Returns the output of the first step that failed, or of ffmpeg if everything worked.
+/// If the host can't be reached, the error is one that is_host_down recognizes.
+pub fn convert(remote: &RemoteHost, input_path: &str, mut ffmpeg_options: Vec<String>, output_path: &str, output_format: &str, measure_volume: bool) -> io::Result<Output> {
+    let host = remote.host.as_str();
+    if let Some(threads) = remote.threads {
+        ffmpeg_options.push(String::from("-threads"));
+        ffmpeg_options.push(format!("{}", threads));
+    }
+    let mktemp = connected(host, ssh(host, "mktemp -d"))?;
+    if !mktemp.status.success() {
+        return Ok(mktemp);
+    }
+    let remote_dir = String::from_utf8_lossy(&mktemp.stdout).trim().to_string();
+    let result = convert_in(host, &remote_dir, input_path, ffmpeg_options, output_path, output_format, measure_volume);
+    // Clean up the temporary directory whether or not the conversion worked
+    if let Err(e) = ssh(host, &format!("rm -rf {}", shell_quote(&remote_dir))) {
+        log::error!("Could not remove {} on {}: {}", remote_dir, host, e);
+    }
+    result
+}
+
+fn convert_in(host: &str, remote_dir: &str, input_path: &str, mut ffmpeg_options: Vec<String>, output_path: &str, output_format: &str, measure_volume: bool) -> io::Result<Output> {
+    // Remote files get fixed names so they never need escaping. The input keeps its extension
+    // since ffmpeg uses it when detecting the input format.
+    let extension = path::Path::new(input_path).extension().and_then(|e| e.to_str()).unwrap_or("");
+    let remote_input = format!("{}/input.{}", remote_dir, extension);
+    let remote_output = format!("{}/output.{}", remote_dir, output_format);
+    let upload = connected(host, scp(&local_scp_path(input_path), &format!("{}:{}", host, remote_input)))?;
+    if !upload.status.success() {
+        return Ok(upload);
+    }
+    if measure_volume {
+        match remote_max_volume(host, &remote_input) {
+            Some(max_volume) => {
+                if let Some(filter) = crate::peak_volume_filter(max_volume) {
+                    ffmpeg_options.insert(0, filter);
+                    ffmpeg_options.insert(0, String::from("-filter:a"));
+                }
+            },
+            None => log::error!("Could not measure volume of {} on {}, converting without normalizing", input_path, host),
+        }
+    }
+    let mut ffmpeg = format!("ffmpeg -y -i {}", shell_quote(&remote_input));
+    for option in &ffmpeg_options {
+        ffmpeg.push(' ');
+        ffmpeg.push_str(&shell_quote(option));
+    }
+    ffmpeg.push(' ');
+    ffmpeg.push_str(&shell_quote(&remote_output));
+    // ffmpeg exiting with 255 itself (e.g. killed on the host) also counts as the host going down,
+    // which only means the song gets converted locally
+    let convert_output = connected(host, ssh(host, &ffmpeg))?;
+    if !convert_output.status.success() {
+        return Ok(convert_output);
+    }
+    let download = connected(host, scp(&format!("{}:{}", host, remote_output), &local_scp_path(output_path)))?;
+    if !download.status.success() {
+        return Ok(download);
+    }
+    Ok(convert_output)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_parse_host() {
+        let remote = parse_host("klu@studio:4").unwrap();
+        assert_eq!("klu@studio", remote.host);
+        assert_eq!(4, remote.slots);
+        assert_eq!(1, parse_host("studio").unwrap().slots);
+        assert!(parse_host("studio:0").is_none());
+        assert!(parse_host("studio:many").is_none());
+        assert!(parse_host(":4").is_none());
+    }
+
+    #[test]
+    fn test_shell_quote() {
+        assert_eq!("'volume=-1.5dB'", shell_quote("volume=-1.5dB"));
+        assert_eq!("'Rufus and Chaka'\\''s Body Heat'", shell_quote("Rufus and Chaka's Body Heat"));
+    }
+
+    #[cfg(unix)]
+    #[test]
+    fn test_connected() {
+        use std::os::unix::process::ExitStatusExt;
+        use std::process::ExitStatus;
+        let output = |code: i32| Output { status: ExitStatus::from_raw(code << 8), stdout: Vec::new(), stderr: Vec::new() };
+        assert!(is_host_down(&connected("studio", Ok(output(255))).unwrap_err()));
+        assert!(is_host_down(&connected("studio", Err(io::Error::from(io::ErrorKind::NotFound))).unwrap_err()));
+        // A failed conversion on a reachable host is passed through
+        assert!(!connected("studio", Ok(output(1))).unwrap().status.success());
+    }
+
+    #[test]
+    fn test_local_scp_path() {
+        assert_eq!("/home/klu/Music/A: B.flac", local_scp_path("/home/klu/Music/A: B.flac"));
+        assert_eq!("./A: B.flac", local_scp_path("A: B.flac"));
+    }
+}
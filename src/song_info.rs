@@ -1,7 +1,9 @@
 use serde::{de::Error, Deserialize, Deserializer, Serialize};
-use std::io;
-use std::process::Command;
+use std::io::{self, BufRead, BufReader};
+use std::process::{Command, Stdio};
 use std::path;
+use std::sync::OnceLock;
+use crate::probe_cache;
 
 /// enum for various audio formats
 #[derive(Debug)]
@@ -21,6 +23,8 @@ pub struct SongInfo {
     sample_rate: usize,
     bit_info: usize,
     tags: Option<serde_json::Value>,
+    // Peak volume is expensive to measure, so it is only computed on first use
+    max_volume: OnceLock<Option<f64>>,
 }
 
 /// Helper struct that represents initial read from ffprobe
@@ -64,17 +68,30 @@ struct ProbeFormat {
 }
 
 /// Executes the ffprobe command to get the stream and format info.
+/// Everything is gathered in a single ffprobe call, and only the fields we deserialize are requested.
 fn run_ffprobe(path: &str) -> io::Result<Probe> {
-    // Run ffprobe
+    // Skip ffprobe entirely if the file hasn't changed since it was last probed
+    if let Some(probe) = probe_cache::get(path) {
+        return Ok(serde_json::from_value(probe)?);
+    }
+    // Run ffprobe. It only accepts a single input and has no mode for reading paths from stdin,
+    // so each file needs its own process; the probe cache is what saves these on later runs
     let output = Command::new("ffprobe")
+        .arg("-v")
+        .arg("quiet")
         .arg(path)
-        .arg("-show_streams")
-        .arg("-show_format")
+        .arg("-show_entries")
+        .arg("stream=codec_name,sample_rate,sample_fmt,bit_rate:format=format_name:format_tags")
         .arg("-print_format")
         .arg("json")
         .output()?;
+    let probe: serde_json::Value = serde_json::from_slice(&output.stdout)?;
+    // Only cache successful probes so files ffprobe couldn't read get retried next run
+    if probe.get("streams").is_some() && probe.get("format").is_some() {
+        probe_cache::insert(path, probe.clone());
+    }
     // Store the results as a struct
-    Ok(serde_json::from_slice(&output.stdout)?)
+    Ok(serde_json::from_value(probe)?)
 }
 
 /// Initializes a Song struct
@@ -89,13 +106,6 @@ pub fn from_file(path: &str) -> Option<SongInfo> {
                     "mp3" | "ogg" | "aac" => AudioFormatType::Lossy,
                     _ => AudioFormatType::Unsupported,
                 };
-                // splitting the path will return the full file name
-                // then extract the name before the period
-                // since this part of code only runs if a valid path was found
-                // unwraps are guaranteed to work, so this will not panic
-                // TO-DO: This won't work with Windows! Look over PathBuf options to see how to extract the filename
-                
-                
                 // based on the format type, bit info will either be the sample_fmt, or bit_rate
                 let bit_info = match format_type {
                     AudioFormatType::Lossless => s[0].sample_fmt.unwrap_or(0),
@@ -110,6 +120,7 @@ pub fn from_file(path: &str) -> Option<SongInfo> {
                     sample_rate: s[0].sample_rate.unwrap_or(0),
                     bit_info,
                     tags: f.tags,
+                    max_volume: OnceLock::new(),
                 })
             }
             _ => {
@@ -123,6 +134,63 @@ pub fn from_file(path: &str) -> Option<SongInfo> {
     }
 }
 
+/// ffmpeg arguments that run volumedetect on a file, shared by local and remote measurements
+pub fn volumedetect_args(input: &str) -> Vec<String> {
+    vec![
+        String::from("-nostats"), // keep the progress line out of stderr
+        String::from("-hide_banner"),
+        String::from("-i"),
+        String::from(input),
+        String::from("-map"), // only decode the audio, not any embedded cover art
+        String::from("0:a:0"),
+        String::from("-filter:a"),
+        String::from("volumedetect"),
+        String::from("-f"),
+        String::from("null"),
+        String::from("-"), //null output that ffmpeg requires
+    ]
+}
+
+// Helper function to find the peak RMS of an audio file
+fn get_max_volume(path: &str) -> Option<f64> {
+    let child = Command::new("ffmpeg")
+        .args(volumedetect_args(path))
+        .stdin(Stdio::null())
+        .stdout(Stdio::null())
+        .stderr(Stdio::piped())
+        .spawn();
+    let mut child = match child {
+        Ok(c) => c,
+        Err(e) => {
+            log::error!("Could not run volumedetect for {}: {}", path, e);
+            return None;
+        }
+    };
+    // Stream stderr line by line instead of buffering all of it, parsing the max volume as it goes by
+    let mut max_volume = None;
+    if let Some(stderr) = child.stderr.take() {
+        for l in BufReader::new(stderr).split(b'\n').filter_map(|l| l.ok()) {
+            if let Some(v) = parse_max_volume(&String::from_utf8_lossy(&l)) {
+                max_volume = Some(v);
+            }
+        }
+    }
+    // Always wait on ffmpeg so it doesn't linger as a zombie process
+    if let Err(e) = child.wait() {
+        log::error!("Error waiting on volumedetect for {}: {}", path, e);
+    }
+    if max_volume.is_none() {
+        log::error!("Volume for {} not parsed correctly!", path);
+    }
+    max_volume
+}
+
+/// Parses the level out of a volumedetect line like "[Parsed_volumedetect_0 @ 0x...] max_volume: -1.0 dB"
+pub fn parse_max_volume(line: &str) -> Option<f64> {
+    let (_, level) = line.split_once("max_volume:")?;
+    level.trim().strip_suffix("dB")?.trim().parse::<f64>().ok()
+}
+
 impl SongInfo {
     pub fn get_codec(&self) -> &str {
         self.codec.as_str()
@@ -142,8 +210,9 @@ impl SongInfo {
 
     pub fn get_song_name(&self) -> Option<&str> {
         let path = path::Path::new(&self.song_path);
-        if let Some(s) = path.file_name().unwrap().to_str() {
-            return s.split('.').next();
+        // file_stem only drops the last extension, so names with periods in them stay intact
+        if let Some(s) = path.file_stem().and_then(|s| s.to_str()) {
+            return Some(s);
         } else {
             log::error!("Unable to parse out file name from path for {}", self.song_path);
         }
@@ -162,6 +231,34 @@ impl SongInfo {
         &self.tags
     }
 
+    /// Returns the value of a tag, or None if the song doesn't have it (or has no tags at all, like most WAVs).
+    /// Tag names vary in case depending on the container and tagger, so a case-insensitive match is
+    /// used when there is no exact one.
+    pub fn get_tag(&self, name: &str) -> Option<&str> {
+        let tags = self.tags.as_ref()?.as_object()?;
+        let value = match tags.get(name) {
+            Some(v) => v,
+            None => tags.iter().find(|(k, _)| k.eq_ignore_ascii_case(name)).map(|(_, v)| v)?,
+        };
+        value.as_str()
+    }
+
+    /// Returns the peak volume of the song in dB. The ReplayGain track peak tag is used when the song has one,
+    /// otherwise volumedetect is run the first time it's needed
+    pub fn get_max_volume(&self) -> Option<f64> {
+        *self.max_volume.get_or_init(|| self.get_replaygain_peak().or_else(|| get_max_volume(&self.song_path)))
+    }
+
+    /// Reads the ReplayGain track peak tag, a linear amplitude, and converts it to dB
+    pub fn get_replaygain_peak(&self) -> Option<f64> {
+        let peak = self.get_tag("REPLAYGAIN_TRACK_PEAK")?.trim().parse::<f64>().ok()?;
+        if peak > 0.0 {
+            Some(20.0 * peak.log10())
+        } else {
+            None
+        }
+    }
+
     pub fn is_rekordbox_format(&self) -> bool {
         match self.format.as_str() {
             "aiff" | "wav" | "mp3" | "aac" => true,
@@ -171,7 +268,7 @@ impl SongInfo {
 }
 
 #[cfg(test)]
-mod tests {
+pub(crate) mod tests {
     use super::*;
 
     #[test]
@@ -214,4 +311,59 @@ mod tests {
 
         assert!(from_file("dummy").unwrap().get_song_name().is_none());
     }
+
+    #[test]
+    fn test_parse_max_volume() {
+        assert_eq!(Some(-1.0), parse_max_volume("[Parsed_volumedetect_0 @ 0x55d4c8] max_volume: -1.0 dB"));
+        assert_eq!(Some(0.0), parse_max_volume("[Parsed_volumedetect_0 @ 0x55d4c8] max_volume: 0.0 dB\r"));
+        assert_eq!(None, parse_max_volume("[Parsed_volumedetect_0 @ 0x55d4c8] mean_volume: -14.2 dB"));
+        assert_eq!(None, parse_max_volume("[Parsed_volumedetect_0 @ 0x55d4c8] n_samples: 1000"));
+    }
+
+    #[test]
+    fn test_get_volume() {
+        assert_eq!(get_max_volume("/home/klu/Music/Hanna - Intercession, On Behalf.flac").unwrap(), -1.0);
+        assert!(get_max_volume("dummy.mp3").is_none());
+    }
+
+    /// 16 bit, 44.1 kHz lossless song that doesn't exist on disk
+    pub(crate) fn lossless_song_info(format: &str, tags: Option<serde_json::Value>) -> SongInfo {
+        SongInfo {
+            codec: String::from(format),
+            format: String::from(format),
+            format_type: AudioFormatType::Lossless,
+            song_path: format!("missing.{}", format),
+            sample_rate: 44100,
+            bit_info: 16,
+            tags,
+            max_volume: OnceLock::new(),
+        }
+    }
+
+    pub(crate) fn flac_song_info(tags: Option<serde_json::Value>) -> SongInfo {
+        lossless_song_info("flac", tags)
+    }
+
+    #[test]
+    fn test_get_max_volume_from_replaygain_tag() {
+        let info = flac_song_info(Some(serde_json::json!({"replaygain_track_peak": "0.5"})));
+        assert!((info.get_max_volume().unwrap() + 6.0206).abs() < 0.001);
+    }
+
+    #[test]
+    fn test_get_song_name_keeps_periods() {
+        let mut info = flac_song_info(None);
+        info.song_path = String::from("/home/klu/Music/01. Intro.flac");
+        assert_eq!("01. Intro", info.get_song_name().unwrap());
+    }
+
+    #[test]
+    fn test_get_tag() {
+        let info = flac_song_info(Some(serde_json::json!({"CONVERT_FOR_REKORDBOX": "1", "Genre": "House"})));
+        assert_eq!(Some("1"), info.get_tag("CONVERT_FOR_REKORDBOX"));
+        assert_eq!(Some("House"), info.get_tag("GENRE"));
+        assert_eq!(None, info.get_tag("REKORDBOX_READY"));
+
+        assert_eq!(None, flac_song_info(None).get_tag("CONVERT_FOR_REKORDBOX"));
+    }
 }